@@ -7,37 +7,126 @@ Enhanced with JSON validation for scalability
 import os
 import json
 import time
-from typing import Dict, Any, Tuple, List
-from anthropic import Anthropic
+import random
+import asyncio
+import functools
+import threading
+import weakref
+from collections import deque
+from typing import Dict, Any, Tuple, List, Callable, Optional, TextIO
+import anthropic
+from anthropic import AsyncAnthropic
 from dotenv import load_dotenv
 import jsonschema
 from jsonschema import Draft7Validator
+import fastjsonschema
 
 # Load environment variables
 load_dotenv()
 
-# Initialize Anthropic client
-client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+# Anthropic clients, one per event loop. The async client's connection pool is
+# bound to the loop it first runs on, so separate asyncio.run() calls in one
+# process each need their own.
+_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncAnthropic]" = weakref.WeakKeyDictionary()
+
+
+def get_client() -> AsyncAnthropic:
+    """Return the Anthropic client for the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    client = _CLIENTS.get(loop)
+    if client is None:
+        # SDK defaults, except idle connections are kept long enough to survive
+        # the user typing at the prompts (the httpx default is 5 seconds).
+        # type(DEFAULT_CONNECTION_LIMITS) is the httpx Limits class the SDK uses.
+        limits = type(anthropic.DEFAULT_CONNECTION_LIMITS)(
+            max_connections=1000,
+            max_keepalive_connections=100,
+            keepalive_expiry=CONNECTION_KEEPALIVE_EXPIRY
+        )
+        # SDK-level retries are disabled; call_claude applies its own backoff policy
+        client = _CLIENTS[loop] = AsyncAnthropic(
+            api_key=os.getenv("ANTHROPIC_API_KEY"),
+            max_retries=0,
+            http_client=anthropic.DefaultAsyncHttpxClient(limits=limits)
+        )
+    return client
+
 
 # Configuration
-MODEL = "claude-3-opus-20240229"  # Best quality for demo, consider claude-3-sonnet for cost savings
+# Question generation needs the stronger model; scoring against a fixed rubric
+# is a classification task that the faster tier handles well.
+# Set ASSESSMENT_MODEL_TIER=opus to route both calls to Opus for A/B evaluation.
+MODEL_OPUS = "claude-opus-4-5"
+MODEL_TIER = os.getenv("ASSESSMENT_MODEL_TIER", "default").lower()
+if MODEL_TIER not in ("default", "opus"):
+    raise ValueError(f"Unknown ASSESSMENT_MODEL_TIER {MODEL_TIER!r}; expected 'default' or 'opus'")
+if MODEL_TIER == "opus":
+    MODEL_GENERATE = MODEL_OPUS
+    MODEL_SCORE = MODEL_OPUS
+else:
+    MODEL_GENERATE = "claude-sonnet-4-5"
+    MODEL_SCORE = "claude-haiku-4-5"
 MAX_TOKENS = 1000
 
+# Input+output tokens per minute to stay under (match your API tier's TPM limit)
+TPM_LIMIT = int(os.getenv("ASSESSMENT_TPM_LIMIT", "40000"))
+CHARS_PER_TOKEN = 4
+
+# Max seconds to wait for the connection warmup before the first API call
+PREWARM_TIMEOUT = 2.0
+
+# Seconds an idle pooled connection is kept open client-side, so the warmed
+# connection is still usable after the user finishes typing
+CONNECTION_KEEPALIVE_EXPIRY = 300.0
+
+# Message Batches API polling interval (seconds) for offline scoring
+BATCH_POLL_INTERVAL = 30
+
+# API retry policy: exponential backoff with full jitter, capped
+API_MAX_RETRIES = 5
+API_BACKOFF_BASE = 1.0
+API_BACKOFF_CAP = 30.0
+
+
+class ModelUnavailableError(Exception):
+    """The configured model does not exist or is not accessible."""
+
+
 # Operational Metrics
-METRICS = {
-    "api_calls": 0,
-    "validation_attempts": 0,
-    "validation_failures": 0,
-    "api_retry_count": 0,
-    "first_attempt_success": 0,
-    "fallback_used": 0
-}
+class Metrics:
+    """Operational counters for a single run."""
+    __slots__ = (
+        "api_calls",
+        "validation_attempts",
+        "validation_failures",
+        "api_retry_count",
+        "first_attempt_success",
+        "fallback_used",
+        "cache_read_tokens"
+    )
+    
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+
+METRICS = Metrics()
 
 # JSON Schemas for validation
 SCHEMAS = {
     "question_rubric": {
         "type": "object",
         "required": ["question", "rubric"],
+        "definitions": {
+            "level": {
+                "type": "object",
+                "required": ["criteria", "example"],
+                "properties": {
+                    "criteria": {"type": "string", "minLength": 10},
+                    "example": {"type": "string", "minLength": 10}
+                }
+            }
+        },
         "properties": {
             "question": {
                 "type": "string",
@@ -48,30 +137,9 @@ SCHEMAS = {
                 "type": "object",
                 "required": ["poor", "adequate", "excellent"],
                 "properties": {
-                    "poor": {
-                        "type": "object",
-                        "required": ["criteria", "example"],
-                        "properties": {
-                            "criteria": {"type": "string", "minLength": 10},
-                            "example": {"type": "string", "minLength": 10}
-                        }
-                    },
-                    "adequate": {
-                        "type": "object",
-                        "required": ["criteria", "example"],
-                        "properties": {
-                            "criteria": {"type": "string", "minLength": 10},
-                            "example": {"type": "string", "minLength": 10}
-                        }
-                    },
-                    "excellent": {
-                        "type": "object",
-                        "required": ["criteria", "example"],
-                        "properties": {
-                            "criteria": {"type": "string", "minLength": 10},
-                            "example": {"type": "string", "minLength": 10}
-                        }
-                    }
+                    "poor": {"$ref": "#/definitions/level"},
+                    "adequate": {"$ref": "#/definitions/level"},
+                    "excellent": {"$ref": "#/definitions/level"}
                 }
             }
         }
@@ -97,11 +165,29 @@ SCHEMAS = {
     }
 }
 
-# Prompt Templates
-QUESTION_RUBRIC_PROMPT = """Generate an educational assessment question and scoring rubric.
+# Combined output for the single-call fused assessment. Definitions are hoisted
+# to the root so the rubric's local $refs still resolve.
+SCHEMAS["fused_assessment"] = {
+    "type": "object",
+    "required": ["question_rubric", "score"],
+    "definitions": SCHEMAS["question_rubric"]["definitions"],
+    "properties": {
+        "question_rubric": {
+            key: value for key, value in SCHEMAS["question_rubric"].items() if key != "definitions"
+        },
+        "score": SCHEMAS["score_result"]
+    }
+}
 
-Subject: {subject}
-Topic: {topic}
+# Prompt Templates
+# Static instructions and the schema live in the system prompt, which is marked
+# cacheable; only the per-request variables go in the user message. The API
+# ignores cache_control on prefixes shorter than the model's minimum cacheable
+# length (at least 1,024 tokens), which these prompts currently are, so caching
+# only takes effect once the prompts grow past it. The scoring system prompt
+# embeds the question and rubric, so it is only reusable across students
+# answering the same question.
+QUESTION_RUBRIC_SYSTEM_PROMPT = """Generate an educational assessment question and scoring rubric.
 
 You MUST respond with ONLY valid JSON (no markdown code blocks, no explanations).
 
@@ -111,11 +197,14 @@ Required JSON structure:
 Requirements:
 1. Question must be answerable in approximately 100 words
 2. Question should test understanding of the topic
-3. Each rubric level must have clear criteria and a specific example
+3. Each rubric level must have clear criteria and a specific example"""
+
+QUESTION_RUBRIC_PROMPT = """Subject: {subject}
+Topic: {topic}
 
 Generate the JSON now:"""
 
-SCORING_PROMPT = """Score the following student response using the provided rubric.
+SCORING_SYSTEM_PROMPT = """Score the following student response using the provided rubric.
 
 Question: {question}
 
@@ -124,29 +213,190 @@ Scoring Rubric:
 - Adequate: {adequate_criteria}
 - Excellent: {excellent_criteria}
 
-Student Response: {response}
+You MUST respond with ONLY valid JSON (no markdown code blocks, no explanations).
+
+Required JSON structure:
+{schema}"""
+
+SCORING_PROMPT = """Student Response: {response}
+
+Evaluate and return the JSON score:"""
+
+FUSED_SYSTEM_PROMPT = """Generate an educational assessment question and scoring rubric, then score the provided student response against that rubric.
 
 You MUST respond with ONLY valid JSON (no markdown code blocks, no explanations).
 
 Required JSON structure:
 {schema}
 
-Evaluate and return the JSON score:"""
+Requirements:
+1. Question must be answerable in approximately 100 words
+2. Question should test understanding of the topic
+3. Each rubric level must have clear criteria and a specific example
+4. The score must evaluate the student response using the rubric you generated"""
+
+FUSED_PROMPT = """Subject: {subject}
+Topic: {topic}
+
+Student Response: {response}
+
+Generate the JSON now:"""
+
+
+def _embed_schema(template: str, schema: Dict[str, Any]) -> str:
+    """Embed a schema into a prompt template, escaping its braces for str.format."""
+    schema_str = json.dumps(schema, indent=2).replace("{", "{{").replace("}", "}}")
+    return template.replace("{schema}", schema_str)
+
+
+# System prompts with the schema already embedded, built once at import so the
+# cached prefix stays byte-identical across requests
+SYSTEM_PROMPTS = {
+    "question_rubric": _embed_schema(QUESTION_RUBRIC_SYSTEM_PROMPT, SCHEMAS["question_rubric"]),
+    "score_result": _embed_schema(SCORING_SYSTEM_PROMPT, SCHEMAS["score_result"]),
+    "fused_assessment": _embed_schema(FUSED_SYSTEM_PROMPT, SCHEMAS["fused_assessment"])
+}
+
+# Quoted key names that must appear in a raw response before it is worth parsing
+REQUIRED_KEYS = {
+    "question_rubric": ('"question"', '"rubric"', '"criteria"'),
+    "score_result": ('"score_level"', '"confidence"', '"rationale"'),
+    "fused_assessment": ('"question_rubric"', '"score"', '"criteria"', '"score_level"')
+}
+
+# Shortest raw response that could satisfy each schema: the sum of its required
+# strings' minLength values. No upper bound is needed since MAX_TOKENS already
+# caps the response length.
+MIN_RESPONSE_LENGTH = {
+    "question_rubric": 20 + 6 * 10,
+    "score_result": 50,
+    "fused_assessment": 20 + 6 * 10 + 50
+}
+
+_DECODER = json.JSONDecoder()
+
+def _validate_score(data: Any) -> bool:
+    """Hand-written equivalent of the score_result schema."""
+    if not isinstance(data, dict):
+        return False
+    confidence = data.get("confidence")
+    rationale = data.get("rationale")
+    return (
+        data.get("score_level") in ("poor", "adequate", "excellent")
+        and isinstance(confidence, (int, float)) and not isinstance(confidence, bool)
+        and 0.0 <= confidence <= 1.0
+        and isinstance(rationale, str) and len(rationale) >= 50
+    )
+
+
+_STRING_KEYWORDS = {"type", "minLength", "maxLength"}
+_OBJECT_KEYWORDS = {"type", "required", "properties", "definitions"}
+
+
+def _compile_string_constraints(root: Dict[str, Any], node: Dict[str, Any] = None,
+                                path: Tuple[str, ...] = ()) -> List[Tuple[Tuple[str, ...], int, Optional[int]]]:
+    """Flatten nested required string properties into (path, min_len, max_len) tuples.
+    
+    Local $refs are resolved against the root. Only the object/string subset
+    of JSON Schema used by question_rubric is supported; anything else raises
+    ValueError at import rather than being silently ignored.
+    """
+    node = root if node is None else node
+    where = "/".join(path) or "<root>"
+    if "$ref" in node:
+        ref = node["$ref"]
+        if set(node) != {"$ref"} or not ref.startswith("#/"):
+            raise ValueError(f"Unsupported $ref at {where}: {node!r}")
+        target = root
+        for key in ref[2:].split("/"):
+            target = target[key]
+        node = target
+    if node.get("type") == "string":
+        unsupported = set(node) - _STRING_KEYWORDS
+        if unsupported:
+            raise ValueError(f"Unsupported string keywords at {where}: {sorted(unsupported)}")
+        return [(path, node.get("minLength", 0), node.get("maxLength"))]
+    unsupported = set(node) - _OBJECT_KEYWORDS
+    if node.get("type") != "object" or unsupported:
+        raise ValueError(f"Unsupported schema at {where}: {sorted(unsupported) or node.get('type')}")
+    properties = node.get("properties", {})
+    if set(properties) != set(node.get("required", ())):
+        raise ValueError(f"Optional or undeclared properties at {where} are not supported")
+    constraints = []
+    for key in node["required"]:
+        constraints.extend(_compile_string_constraints(root, properties[key], path + (key,)))
+    return constraints
+
+
+# Precompiled once at import; every question_rubric leaf is a required string
+_QUESTION_RUBRIC_CONSTRAINTS = _compile_string_constraints(SCHEMAS["question_rubric"])
+
+
+def _validate_question_rubric(data: Any) -> bool:
+    """Check question_rubric in one pass over its flattened string constraints."""
+    for path, min_len, max_len in _QUESTION_RUBRIC_CONSTRAINTS:
+        value = data
+        for key in path:
+            if not isinstance(value, dict):
+                return False
+            value = value.get(key)
+        if not isinstance(value, str) or len(value) < min_len:
+            return False
+        if max_len is not None and len(value) > max_len:
+            return False
+    return True
+
+
+# Hand-written checks for fixed schemas, used in place of the schema engine
+_SPECIALIZED_VALIDATORS: Dict[int, Callable[[Any], bool]] = {
+    id(SCHEMAS["question_rubric"]): _validate_question_rubric,
+    id(SCHEMAS["score_result"]): _validate_score
+}
+
+
+# Compiled validators, keyed by id() of the schema dict (SCHEMAS is never mutated).
+# Schemas with a specialized check skip fastjsonschema; the rest get a generated
+# function for the fast path. Draft7Validator is only used to collect detailed
+# error messages on failure.
+_VALIDATORS: Dict[int, Draft7Validator] = {}
+_FAST_VALIDATORS: Dict[int, Callable[[Any], Any]] = {}
+
+for _schema in SCHEMAS.values():
+    Draft7Validator.check_schema(_schema)
+    _VALIDATORS[id(_schema)] = Draft7Validator(_schema)
+    if id(_schema) not in _SPECIALIZED_VALIDATORS:
+        _FAST_VALIDATORS[id(_schema)] = fastjsonschema.compile(_schema)
 
 
 def validate_json(data: Dict[str, Any], schema: Dict[str, Any]) -> Tuple[bool, List[str]]:
     """Validate JSON against schema, return (is_valid, errors)."""
-    global METRICS
-    METRICS["validation_attempts"] += 1
+    METRICS.validation_attempts += 1
+    
+    check = _SPECIALIZED_VALIDATORS.get(id(schema))
+    if check is not None:
+        if check(data):
+            return True, []
+    else:
+        fast_validate = _FAST_VALIDATORS.get(id(schema))
+        if fast_validate is None:
+            fast_validate = _FAST_VALIDATORS.setdefault(id(schema), fastjsonschema.compile(schema))
+        try:
+            fast_validate(data)
+            return True, []
+        except fastjsonschema.JsonSchemaException:
+            pass
     
-    validator = Draft7Validator(schema)
+    # Slow path: collect detailed errors for the retry prompt
+    validator = _VALIDATORS.get(id(schema))
+    if validator is None:
+        validator = _VALIDATORS.setdefault(id(schema), Draft7Validator(schema))
     errors = []
     for error in validator.iter_errors(data):
         error_path = " -> ".join(str(p) for p in error.path)
         errors.append(f"{error_path}: {error.message}" if error_path else error.message)
     
     if errors:
-        METRICS["validation_failures"] += 1
+        METRICS.validation_failures += 1
     
     return len(errors) == 0, errors
 
@@ -179,6 +429,11 @@ def generate_default_from_schema(schema_name: str, context: Dict[str, str] = Non
             "confidence": 0.7,
             "rationale": "The response demonstrates basic understanding of the topic with room for improvement in detail and accuracy."
         }
+    elif schema_name == "fused_assessment":
+        return {
+            "question_rubric": generate_default_from_schema("question_rubric", context),
+            "score": generate_default_from_schema("score_result", context)
+        }
     return {}
 
 
@@ -199,89 +454,338 @@ def get_user_input() -> Dict[str, str]:
     return {"subject": subject, "topic": topic}
 
 
-def call_claude(prompt: str, retry_with_error: str = None) -> str:
+async def run_in_daemon_thread(func: Callable[[], Any]) -> Any:
+    """Run a blocking call (e.g. input()) on a daemon thread and await its result.
+    
+    Unlike asyncio.to_thread, the thread is not part of the default executor,
+    so Ctrl-C can exit immediately instead of waiting for input() to return.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    
+    def _settle(setter: Callable[[Any], None], value: Any) -> None:
+        if not future.done():
+            setter(value)
+    
+    def _run() -> None:
+        try:
+            result = func()
+        except BaseException as e:
+            settle = (_settle, future.set_exception, e)
+        else:
+            settle = (_settle, future.set_result, result)
+        try:
+            loop.call_soon_threadsafe(*settle)
+        except RuntimeError:
+            pass  # Loop already closed (e.g. after Ctrl-C)
+    
+    threading.Thread(target=_run, daemon=True).start()
+    return await future
+
+
+async def prewarm_connection() -> None:
+    """Open the API connection ahead of the first real request (best effort).
+    
+    A cheap models request completes the TCP/TLS handshake while the user is
+    typing. The client keeps idle connections for CONNECTION_KEEPALIVE_EXPIRY
+    seconds, so question generation reuses it unless the user takes longer or
+    the server closes the idle socket first; either way the first call just
+    opens a new connection.
+    """
+    try:
+        await get_client().models.list(limit=1)
+    except Exception:
+        pass
+
+
+def cached_system_blocks(text: str) -> List[Dict[str, Any]]:
+    """Wrap static prompt text as a system block eligible for prompt caching."""
+    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+
+
+class TokenBudgetTracker:
+    """Rolling 60-second token budget so calls self-throttle before hitting TPM 429s.
+    
+    wait_if_needed reserves the estimated tokens up front, so concurrent
+    callers see each other's in-flight usage; record_usage then settles the
+    reservation in place (keeping its timestamp) to the actual count reported
+    by the API, or to 0 if the call failed.
+    """
+    
+    def __init__(self, tpm_limit: int, window: float = 60.0):
+        self.tpm_limit = tpm_limit
+        self.window = window
+        self._usage = deque()
+        self._waiters = set()
+    
+    def _used(self, now: float) -> int:
+        while self._usage and now - self._usage[0][0] >= self.window:
+            self._usage.popleft()
+        return sum(entry[1] for entry in self._usage)
+    
+    async def wait_if_needed(self, estimated_tokens: int) -> List[Any]:
+        """Sleep until the window has room for the request, then reserve it.
+        
+        Returns the reservation to pass to record_usage.
+        """
+        while True:
+            now = time.monotonic()
+            used = self._used(now)
+            if not self._usage or used + estimated_tokens <= self.tpm_limit:
+                break
+            # Sleep until the oldest entry expires, or until record_usage
+            # lowers a reservation and frees room earlier
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.add(waiter)
+            try:
+                await asyncio.wait({waiter}, timeout=self._usage[0][0] + self.window - now)
+            finally:
+                self._waiters.discard(waiter)
+        reservation = [time.monotonic(), estimated_tokens]
+        self._usage.append(reservation)
+        return reservation
+    
+    def record_usage(self, reservation: List[Any], tokens: int) -> None:
+        """Replace a reservation's estimate with the actual token count."""
+        lowered = tokens < reservation[1]
+        reservation[1] = tokens
+        if lowered:
+            for waiter in self._waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+
+token_budget = TokenBudgetTracker(TPM_LIMIT)
+
+
+def estimate_tokens(request: Dict[str, Any]) -> int:
+    """Rough upper bound on tokens a request will use (input estimate + max_tokens)."""
+    chars = sum(len(message["content"]) for message in request["messages"])
+    chars += sum(len(block["text"]) for block in request.get("system", ()))
+    return chars // CHARS_PER_TOKEN + request["max_tokens"]
+
+
+class JsonObjectScanner:
+    """Incrementally locate the first complete top-level JSON object in streamed text.
+    
+    Tracks brace depth while skipping braces inside strings and escapes, so a
+    stream can be cut off as soon as the object closes.
+    """
+    
+    def __init__(self):
+        self.buffer = ""
+        self.start = -1
+        self.end = -1
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._pos = 0
+    
+    def feed(self, text: str) -> bool:
+        """Append text; return True once the top-level object is closed."""
+        self.buffer += text
+        buf = self.buffer
+        for i in range(self._pos, len(buf)):
+            c = buf[i]
+            if self.start < 0:
+                if c == "{":
+                    self.start = i
+                    self._depth = 1
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c == "{":
+                self._depth += 1
+            elif c == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.end = i
+                    self._pos = i + 1
+                    return True
+        self._pos = len(buf)
+        return False
+    
+    def text(self) -> str:
+        """Return the completed object, or the whole buffer if it never closed."""
+        if self.end >= 0:
+            return self.buffer[self.start:self.end + 1]
+        return self.buffer
+
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """Return the server-requested Retry-After delay, if any."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_transient_status_error(error: anthropic.APIStatusError) -> bool:
+    """Whether a status error is worth retrying.
+    
+    Errors sent mid-stream as SSE error events carry the stream's HTTP 200
+    status, so they are classified by the error type in the body instead.
+    """
+    if error.status_code >= 500 or error.status_code in (408, 409):
+        return True
+    body = error.body if isinstance(error.body, dict) else {}
+    details = body.get("error")
+    error_type = details.get("type") if isinstance(details, dict) else None
+    return error_type in ("overloaded_error", "api_error")
+
+
+def retry(max_retries: int = API_MAX_RETRIES, base: float = API_BACKOFF_BASE,
+          cap: float = API_BACKOFF_CAP) -> Callable:
+    """Retry transient API failures with exponential backoff and jitter.
+    
+    Rate limits, connection errors, 5xx responses and mid-stream overload or
+    API errors are retried; other status errors (bad request, auth) are
+    raised immediately.
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for attempt in range(max_retries + 1):
+                try:
+                    return await func(*args, **kwargs)
+                except anthropic.RateLimitError as e:
+                    error = e
+                except anthropic.APIStatusError as e:
+                    if not _is_transient_status_error(e):
+                        raise
+                    error = e
+                except anthropic.APIConnectionError as e:
+                    error = e
+                
+                if attempt == max_retries:
+                    raise Exception(f"API call failed after {max_retries} retries: {error}")
+                
+                delay = _retry_after_seconds(error)
+                if delay is None:
+                    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+                print(f"\nAPI Error: {error}")
+                print(f"Retrying in {delay:.1f} seconds...")
+                METRICS.api_retry_count += 1
+                await asyncio.sleep(delay)
+        return wrapper
+    return decorator
+
+
+@retry()
+async def call_claude(prompt: str, retry_with_error: str = None, model: str = MODEL_GENERATE,
+                      system_blocks: List[Dict[str, Any]] = None) -> str:
     """Make API call to Claude with error handling."""
-    global METRICS
-    METRICS["api_calls"] += 1
+    METRICS.api_calls += 1
     
     if retry_with_error:
         prompt += f"\n\nPrevious response had JSON validation errors:\n{retry_with_error}\nPlease provide valid JSON only."
     
+    request = {
+        "model": model,
+        "max_tokens": MAX_TOKENS,
+        "messages": [{"role": "user", "content": prompt}]
+    }
+    if system_blocks:
+        request["system"] = system_blocks
+    
+    reservation = await token_budget.wait_if_needed(estimate_tokens(request))
+    
+    # Stream the response and stop as soon as the JSON object closes,
+    # rather than waiting for trailing text or the max_tokens limit.
+    # A failed call releases its reservation so retries are not throttled
+    # by tokens the API never used.
+    used_tokens = 0
+    scanner = JsonObjectScanner()
     try:
-        response = client.messages.create(
-            model=MODEL,
-            max_tokens=MAX_TOKENS,
-            messages=[{"role": "user", "content": prompt}]
-        )
-        return response.content[0].text
-    except Exception as e:
-        print(f"\nAPI Error: {e}")
-        print("Retrying in 3 seconds...")
-        METRICS["api_retry_count"] += 1
-        time.sleep(3)
-        try:
-            response = client.messages.create(
-                model=MODEL,
-                max_tokens=MAX_TOKENS,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            return response.content[0].text
-        except Exception as e:
-            raise Exception(f"API call failed after retry: {e}")
+        async with get_client().messages.stream(**request) as stream:
+            async for text in stream.text_stream:
+                if scanner.feed(text):
+                    break
+            usage = stream.current_message_snapshot.usage
+        
+        # Output usage is only final if the stream ran to completion, so fall
+        # back to a length estimate when it was cut short
+        output_tokens = max(usage.output_tokens, len(scanner.buffer) // CHARS_PER_TOKEN)
+        used_tokens = usage.input_tokens + output_tokens
+    finally:
+        token_budget.record_usage(reservation, used_tokens)
+    
+    METRICS.cache_read_tokens += getattr(usage, "cache_read_input_tokens", 0) or 0
+    return scanner.text()
 
 
 def parse_json_response(response: str, fallback: Dict[str, Any]) -> Dict[str, Any]:
     """Parse JSON from Claude's response with fallback."""
+    # Decode from the first '{'; raw_decode ignores any surrounding
+    # markdown fences or trailing text in a single pass
+    start_idx = response.find('{')
+    if start_idx == -1:
+        return fallback
     try:
-        # Clean response - remove markdown code blocks if present
-        cleaned = response.strip()
-        if cleaned.startswith("```json"):
-            cleaned = cleaned[7:]
-        if cleaned.startswith("```"):
-            cleaned = cleaned[3:]
-        if cleaned.endswith("```"):
-            cleaned = cleaned[:-3]
-        
-        # Try to extract JSON from the response
-        start_idx = cleaned.find('{')
-        end_idx = cleaned.rfind('}') + 1
-        if start_idx != -1 and end_idx > start_idx:
-            json_str = cleaned[start_idx:end_idx]
-            return json.loads(json_str)
+        parsed, _ = _DECODER.raw_decode(response, start_idx)
+        return parsed
     except json.JSONDecodeError as e:
         print(f"JSON parsing error: {e}")
     
     return fallback
 
 
-def get_valid_json_from_claude(prompt: str, schema: Dict[str, Any], schema_name: str, 
-                               context: Dict[str, str] = None, max_retries: int = 3) -> Dict[str, Any]:
+async def get_valid_json_from_claude(prompt: str, schema: Dict[str, Any], schema_name: str, 
+                                     context: Dict[str, str] = None, max_retries: int = 3,
+                                     model: str = MODEL_GENERATE) -> Dict[str, Any]:
     """Get valid JSON from Claude with retries and schema enforcement."""
-    global METRICS
-    
+    system_blocks = None
     for attempt in range(max_retries):
         try:
-            # Add schema to prompt on first attempt
+            # Fill in templates on first attempt (schema is already embedded)
             if attempt == 0:
-                schema_str = json.dumps(schema, indent=2)
-                prompt = prompt.format(schema=schema_str, **context) if context else prompt
+                if context:
+                    prompt = prompt.format(**context)
+                system_prompt = SYSTEM_PROMPTS.get(schema_name)
+                if system_prompt:
+                    system_blocks = cached_system_blocks(system_prompt.format(**(context or {})))
             
             # Get response with error feedback if retrying
             error_feedback = None
             if attempt > 0:
                 error_feedback = "\n".join(errors)
             
-            response = call_claude(prompt, error_feedback)
-            
-            # Parse JSON
-            parsed = parse_json_response(response, {})
+            try:
+                response = await call_claude(prompt, error_feedback, model=model, system_blocks=system_blocks)
+            except anthropic.NotFoundError as e:
+                # An unavailable model is a configuration error; never mask it with a fallback
+                raise ModelUnavailableError(f"Model {model!r} is not available: {e}") from e
             
-            # Validate against schema
-            is_valid, errors = validate_json(parsed, schema)
+            # Cheap length and substring checks first: skip parsing and schema
+            # validation entirely when the response clearly cannot be valid
+            min_length = MIN_RESPONSE_LENGTH.get(schema_name, 0)
+            missing = [key for key in REQUIRED_KEYS.get(schema_name, ()) if key not in response]
+            if len(response) < min_length or missing:
+                METRICS.validation_attempts += 1
+                METRICS.validation_failures += 1
+                errors = [f"missing required key {key}" for key in missing]
+                if len(response) < min_length:
+                    errors.append(f"response is {len(response)} characters, shorter than the minimum {min_length}")
+                is_valid = False
+            else:
+                # Parse JSON
+                parsed = parse_json_response(response, {})
+                
+                # Validate against schema
+                is_valid, errors = validate_json(parsed, schema)
             
             if is_valid:
                 if attempt == 0:
-                    METRICS["first_attempt_success"] += 1
+                    METRICS.first_attempt_success += 1
                 if attempt > 0:
                     print(f"✅ Valid JSON generated after {attempt + 1} attempts")
                 return parsed
@@ -290,16 +794,18 @@ def get_valid_json_from_claude(prompt: str, schema: Dict[str, Any], schema_name:
                 if attempt < max_retries - 1:
                     print("Retrying with error feedback...")
                 
+        except ModelUnavailableError:
+            raise
         except Exception as e:
             print(f"\n⚠️  Error in attempt {attempt + 1}: {e}")
     
     # Final fallback: return schema-compliant default
     print("\n⚠️  Using fallback response after validation failures")
-    METRICS["fallback_used"] += 1
+    METRICS.fallback_used += 1
     return generate_default_from_schema(schema_name, context)
 
 
-def generate_question_and_rubric(subject: str, topic: str) -> Dict[str, Any]:
+async def generate_question_and_rubric(subject: str, topic: str) -> Dict[str, Any]:
     """Generate question and rubric using Claude with JSON validation."""
     print("\n📝 Generating question and rubric...")
     
@@ -308,11 +814,12 @@ def generate_question_and_rubric(subject: str, topic: str) -> Dict[str, Any]:
         "topic": topic
     }
     
-    result = get_valid_json_from_claude(
+    result = await get_valid_json_from_claude(
         QUESTION_RUBRIC_PROMPT,
         SCHEMAS["question_rubric"],
         "question_rubric",
-        context
+        context,
+        model=MODEL_GENERATE
     )
     
     print("✅ Question and rubric generated with valid JSON!")
@@ -352,29 +859,144 @@ def collect_student_response(question: str) -> str:
     return response
 
 
-def score_response(response: str, question: str, rubric: Dict[str, Any]) -> Dict[str, Any]:
-    """Score the student response using Claude with JSON validation."""
-    print("\n🔍 Scoring response...")
-    
-    context = {
+def build_scoring_context(response: str, question: str, rubric: Dict[str, Any]) -> Dict[str, str]:
+    """Build the template variables for the scoring prompts."""
+    return {
         "question": question,
         "poor_criteria": rubric["poor"]["criteria"],
         "adequate_criteria": rubric["adequate"]["criteria"],
         "excellent_criteria": rubric["excellent"]["criteria"],
         "response": response
     }
+
+
+async def score_response(response: str, question: str, rubric: Dict[str, Any]) -> Dict[str, Any]:
+    """Score the student response using Claude with JSON validation."""
+    print("\n🔍 Scoring response...")
+    
+    context = build_scoring_context(response, question, rubric)
     
-    result = get_valid_json_from_claude(
+    result = await get_valid_json_from_claude(
         SCORING_PROMPT,
         SCHEMAS["score_result"],
         "score_result",
-        context
+        context,
+        model=MODEL_SCORE
     )
     
     print("✅ Scoring complete with valid JSON!")
     return result
 
 
+async def score_batch(items: List[Dict[str, Any]], concurrency: int = 8) -> List[Dict[str, Any]]:
+    """Score many responses concurrently; each item needs response, question and rubric."""
+    sem = asyncio.Semaphore(concurrency)
+    
+    async def _scored(item: Dict[str, Any]) -> Dict[str, Any]:
+        async with sem:
+            return await score_response(item["response"], item["question"], item["rubric"])
+    
+    return await asyncio.gather(*[_scored(item) for item in items])
+
+
+@retry()
+async def _create_batch(requests: List[Dict[str, Any]]) -> Any:
+    """Submit a message batch (retried on transient failures)."""
+    METRICS.api_calls += 1
+    return await get_client().messages.batches.create(requests=requests)
+
+
+@retry()
+async def _retrieve_batch(batch_id: str) -> Any:
+    """Fetch batch status (retried on transient failures)."""
+    return await get_client().messages.batches.retrieve(batch_id)
+
+
+@retry()
+async def _batch_results(batch_id: str) -> List[Any]:
+    """Download all batch results; a transient failure restarts the download."""
+    return [entry async for entry in await get_client().messages.batches.results(batch_id)]
+
+
+async def score_offline(submissions: List[Dict[str, Any]],
+                        poll_interval: float = BATCH_POLL_INTERVAL) -> Dict[str, Optional[Dict[str, Any]]]:
+    """Score submissions through the Message Batches API (half price, no RPM limit).
+    
+    Each submission needs an id (used as the batch custom_id), response,
+    question and rubric. Returns validated scores keyed by submission id.
+    Entries that errored, expired, were canceled or did not validate map to
+    None so callers can resubmit them; no fallback score is substituted.
+    Intended for back-office rescoring where results may take hours.
+    """
+    schema = SCHEMAS["score_result"]
+    
+    requests = []
+    for submission in submissions:
+        context = build_scoring_context(
+            submission["response"], submission["question"], submission["rubric"]
+        )
+        requests.append({
+            "custom_id": submission["id"],
+            "params": {
+                "model": MODEL_SCORE,
+                "max_tokens": MAX_TOKENS,
+                "system": cached_system_blocks(SYSTEM_PROMPTS["score_result"].format(**context)),
+                "messages": [{"role": "user", "content": SCORING_PROMPT.format(**context)}]
+            }
+        })
+    
+    batch = await _create_batch(requests)
+    print(f"\n📦 Submitted batch {batch.id} with {len(requests)} responses")
+    
+    while batch.processing_status != "ended":
+        await asyncio.sleep(poll_interval)
+        batch = await _retrieve_batch(batch.id)
+    
+    scores = {}
+    for entry in await _batch_results(batch.id):
+        result_type = entry.result.type
+        parsed = None
+        if result_type == "succeeded":
+            parsed = parse_json_response(entry.result.message.content[0].text, {})
+            if not validate_json(parsed, schema)[0]:
+                result_type = "invalid"
+                parsed = None
+        if parsed is None:
+            print(f"⚠️  {entry.custom_id}: {result_type}, needs resubmission")
+        scores[entry.custom_id] = parsed
+    
+    failed = sum(score is None for score in scores.values())
+    print(f"✅ Batch {batch.id} complete: {len(scores) - failed} scored, {failed} failed")
+    return scores
+
+
+async def assess_fused(subject: str, topic: str, response: str) -> Dict[str, Any]:
+    """Generate question, rubric and score in a single call for a stored response.
+    
+    For replay and rescoring workflows where the response already exists;
+    the interactive flow still needs the question before the student answers.
+    Returns {"question_rubric": {...}, "score": {...}}.
+    """
+    print("\n📝 Generating and scoring assessment in one call...")
+    
+    context = {
+        "subject": subject,
+        "topic": topic,
+        "response": response
+    }
+    
+    result = await get_valid_json_from_claude(
+        FUSED_PROMPT,
+        SCHEMAS["fused_assessment"],
+        "fused_assessment",
+        context,
+        model=MODEL_GENERATE
+    )
+    
+    print("✅ Fused assessment complete with valid JSON!")
+    return result
+
+
 def display_results(all_data: Dict[str, Any]) -> None:
     """Display the complete assessment results."""
     print("\n" + "="*60)
@@ -410,42 +1032,58 @@ def display_results(all_data: Dict[str, Any]) -> None:
     if save == 'y':
         filename = f"assessment_{all_data['subject']}_{all_data['topic']}.json"
         filename = filename.replace(" ", "_").lower()
-        
-        # Save as proper JSON
-        with open(filename, 'w') as f:
-            json.dump(all_data, f, indent=2)
+        txt_filename = save_results(all_data, filename)
         
         print(f"✅ Results saved to {filename}")
-        
-        # Also save human-readable version
-        txt_filename = filename.replace('.json', '.txt')
-        with open(txt_filename, 'w') as f:
-            f.write("ASSESSMENT RESULTS\n")
-            f.write("="*60 + "\n\n")
-            f.write(f"Subject: {all_data['subject']}\n")
-            f.write(f"Topic: {all_data['topic']}\n")
-            f.write(f"\nQuestion: {all_data['question']}\n")
-            f.write(f"\nStudent Response:\n{all_data['student_response']}\n")
-            f.write(f"\nScore: {all_data['score']['score_level'].upper()}\n")
-            f.write(f"Confidence: {all_data['score']['confidence']:.1%}\n")
-            f.write(f"\nRationale:\n{all_data['score']['rationale']}\n")
-        
         print(f"✅ Human-readable results saved to {txt_filename}")
 
 
-def main():
+def format_text_report(all_data: Dict[str, Any]) -> List[str]:
+    """Build the human-readable report as a list of lines."""
+    score = all_data['score']
+    return [
+        "ASSESSMENT RESULTS\n",
+        "="*60 + "\n\n",
+        f"Subject: {all_data['subject']}\n",
+        f"Topic: {all_data['topic']}\n",
+        f"\nQuestion: {all_data['question']}\n",
+        f"\nStudent Response:\n{all_data['student_response']}\n",
+        f"\nScore: {score['score_level'].upper()}\n",
+        f"Confidence: {score['confidence']:.1%}\n",
+        f"\nRationale:\n{score['rationale']}\n"
+    ]
+
+
+def persist(all_data: Dict[str, Any], json_fp: TextIO, txt_fp: TextIO = None,
+            indent: Optional[int] = 2) -> None:
+    """Write results to already-open file handles.
+    
+    With indent=None the record is written as a single JSON line, so a batch
+    loop can stream many records into one JSONL file.
+    """
+    json.dump(all_data, json_fp, indent=indent)
+    if indent is None:
+        json_fp.write("\n")
+    if txt_fp is not None:
+        txt_fp.writelines(format_text_report(all_data))
+
+
+def save_results(all_data: Dict[str, Any], path: str) -> str:
+    """Save JSON and human-readable results; return the text report path."""
+    txt_path = os.path.splitext(path)[0] + ".txt"
+    if txt_path == path:
+        raise ValueError(f"JSON output path {path!r} would collide with the text report")
+    with open(path, 'w') as json_fp, open(txt_path, 'w') as txt_fp:
+        persist(all_data, json_fp, txt_fp)
+    return txt_path
+
+
+async def run_assessment():
     """Main execution flow."""
     global METRICS
     
     # Reset metrics for clean run
-    METRICS = {
-        "api_calls": 0,
-        "validation_attempts": 0,
-        "validation_failures": 0,
-        "api_retry_count": 0,
-        "first_attempt_success": 0,
-        "fallback_used": 0
-    }
+    METRICS = Metrics()
     
     try:
         # Check API key
@@ -457,11 +1095,15 @@ def main():
         print("\n🚀 AI-Powered Assessment System v2 - With JSON Validation")
         print("="*60)
         
-        # Step 1: Get user input
-        user_input = get_user_input()
+        # Step 1: Get user input, warming up the API connection while the user types
+        warmup = asyncio.create_task(prewarm_connection())
+        user_input = await run_in_daemon_thread(get_user_input)
+        done, _ = await asyncio.wait({warmup}, timeout=PREWARM_TIMEOUT)
+        if not done:
+            warmup.cancel()
         
         # Step 2: Generate question and rubric with validation
-        qa_data = generate_question_and_rubric(
+        qa_data = await generate_question_and_rubric(
             user_input["subject"], 
             user_input["topic"]
         )
@@ -470,7 +1112,7 @@ def main():
         student_response = collect_student_response(qa_data["question"])
         
         # Step 4: Score the response with validation
-        score_data = score_response(
+        score_data = await score_response(
             student_response, 
             qa_data["question"], 
             qa_data["rubric"]
@@ -495,17 +1137,18 @@ def main():
         
         # Display operational metrics
         print("\n📊 Operational Metrics:")
-        print(f"  - Total API Calls: {METRICS['api_calls']}")
+        print(f"  - Total API Calls: {METRICS.api_calls}")
         
-        if METRICS['validation_attempts'] > 0:
-            validation_success_rate = (METRICS['validation_attempts'] - METRICS['validation_failures']) / METRICS['validation_attempts']
+        if METRICS.validation_attempts > 0:
+            validation_success_rate = (METRICS.validation_attempts - METRICS.validation_failures) / METRICS.validation_attempts
             print(f"  - Validation Success Rate: {validation_success_rate:.1%}")
-            print(f"  - First-Attempt Success Rate: {METRICS['first_attempt_success'] / (METRICS['api_calls'] - METRICS['api_retry_count']):.1%}")
+            print(f"  - First-Attempt Success Rate: {METRICS.first_attempt_success / (METRICS.api_calls - METRICS.api_retry_count):.1%}")
         
-        if METRICS['api_calls'] > 0:
-            print(f"  - API Retry Rate: {METRICS['api_retry_count'] / METRICS['api_calls']:.1%}")
+        if METRICS.api_calls > 0:
+            print(f"  - API Retry Rate: {METRICS.api_retry_count / METRICS.api_calls:.1%}")
         
-        print(f"  - Fallback Responses Used: {METRICS['fallback_used']}")
+        print(f"  - Fallback Responses Used: {METRICS.fallback_used}")
+        print(f"  - Prompt Cache Read Tokens: {METRICS.cache_read_tokens}")
         
         print("\n✨ Assessment complete with validated JSON! Thank you for using the AI Assessment System.")
         
@@ -516,5 +1159,10 @@ def main():
         traceback.print_exc()
 
 
+def main():
+    """Synchronous entry point."""
+    asyncio.run(run_assessment())
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file